@@ -1,8 +1,10 @@
 # Imports
 import json
+import threading
+import tensorflow as tf
 import tensorflow.keras as keras
 import numpy as np
-import music21 as m21
+import mido
 from preprocessing import SEQUENCE_LENGTH, MAPPING_PATH
 
 from flask import Flask, request, render_template, send_file
@@ -18,21 +20,66 @@ class MelodyGenerator:
     def __init__(self, model_path="model.h5"):
         
         self.model_path = model_path
-        self.model = keras.models.load_model(model_path)
+        # The model is only used for inference, so skipping compilation avoids restoring the optimizer state and training config from the file
+        self.model = keras.models.load_model(model_path, compile=False)
         
         with open(MAPPING_PATH, "r") as fp:
             self._mappings = json.load(fp)
+        
+        # Inverse mapping (integer -> symbol), so that predictions can be decoded by indexing instead of searching the mappings.
+        self._inv_mappings = [None] * len(self._mappings)
+        for symbol, index in self._mappings.items():
+            self._inv_mappings[index] = symbol
             
         self._start_symbols = ["/"] * SEQUENCE_LENGTH
+        
+        # Random number generator created once and reused for all the sampling, instead of the global random state
+        self._rng = tf.random.Generator.from_non_deterministic_state()
+        
+        # Integer of the end-of-melody symbol, to stop the generation when it is predicted
+        self._end_symbol_int = self._mappings["/"]
+        
+        # The whole generation loop compiled into a single TF graph, so the melody is generated in one call instead of going back and forth between Python and TF for every step.
+        # The input signature fixes the input shapes, so the graph is traced once and reused for every request.
+        self._generate_graph = tf.function(
+            self._generate,
+            input_signature=[
+                tf.TensorSpec(shape=(1, None, len(self._mappings)), dtype=tf.float32),
+                tf.TensorSpec(shape=(), dtype=tf.int32),
+                tf.TensorSpec(shape=(), dtype=tf.float32)
+            ]
+        )
     
     def _sample_with_temperature(self, probabilities, temperature):
-        predictions = np.log(probabilities) / temperature
-        probabilities = np.exp(predictions) / np.sum(np.exp(predictions))
+        # Sampling with the Gumbel-max trick: taking the argmax of the temperature-scaled log-probabilities plus Gumbel noise is equivalent to sampling from their softmax, without normalizing or building a cumulative distribution.
+        predictions = tf.math.log(probabilities) / temperature
+        gumbel_noise = -tf.math.log(-tf.math.log(self._rng.uniform(tf.shape(predictions))))
         
-        choices = range(len(probabilities))
-        index = np.random.choice(choices, p=probabilities)
+        index = tf.argmax(predictions + gumbel_noise, output_type=tf.int32)
         
         return index
+    
+    def _generate(self, onehot_seed, num_steps, temperature):
+        # Runs inside the TF graph: AutoGraph converts the loop to a 'tf.while_loop' and the 'if' to a 'tf.cond'.
+        output_ints = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+        
+        for step in tf.range(num_steps):
+            # Making prediction
+            probabilities = self.model(onehot_seed, training=False)[0]
+            
+            output_int = self._sample_with_temperature(probabilities, temperature)
+            
+            # Checking if we are at the end of the melody
+            if output_int == self._end_symbol_int:
+                break
+            
+            output_ints = output_ints.write(step, output_int)
+            
+            # Update the seed by dropping its first step and adding the new one-hot vector at the end
+            onehot_output = tf.one_hot(tf.reshape(output_int, (1, 1)), len(self._mappings))
+            onehot_seed = tf.concat([onehot_seed[:, 1:], onehot_output], axis=1)
+        
+        return output_ints.stack()
         
     def generate_melody(self, seed, num_steps, max_sequence_length, temperature):
         
@@ -41,43 +88,28 @@ class MelodyGenerator:
         melody = seed
         seed = self._start_symbols + seed
         
-        # Map seed to integers
-        seed = [self._mappings[symbol] for symbol in seed]
+        # Map seed to integers, limiting the seed to the max sequence length
+        seed = [self._mappings[symbol] for symbol in seed][-max_sequence_length:]
         
-        for _ in range(num_steps):
-            # Limit the seed to the max sequence length
-            seed = seed[-max_sequence_length:]
-            
-            # One-hot encoding the seed
-            onehot_seed = keras.utils.to_categorical(seed, num_classes=len(self._mappings))
-            # Adding extra-dimension because model.predict() expects a 3-d input. The onehot_seed's dimension currently is (max_sequence_length, vocabulary size)
-            onehot_seed = onehot_seed[np.newaxis, ...]
-            
-            # Making prediction
-            probabilities = self.model.predict(onehot_seed)[0]
-            
-            output_int = self._sample_with_temperature(probabilities, temperature)
-            
-            # Update the seed
-            seed.append(output_int)
-            
-            # Map integers to our encoding
-            output_symbol = [k for k, v in self._mappings.items() if v == output_int][0]
-            
-            # Checking if we are at the end of the melody
-            if output_symbol == "/":
-                break
-                
-            # Updating the melody
-            melody.append(output_symbol)
+        # One-hot encoding the seed. Adding extra-dimension because the model expects a 3-d input, so the seed's dimension is (1, max_sequence_length, vocabulary size)
+        onehot_seed = np.zeros((1, len(seed), len(self._mappings)), dtype=np.float32)
+        onehot_seed[0, np.arange(len(seed)), seed] = 1.0
+        
+        # Generating the whole melody in a single graph call
+        output_ints = self._generate_graph(
+            tf.constant(onehot_seed),
+            tf.constant(num_steps, dtype=tf.int32),
+            tf.constant(temperature, dtype=tf.float32)
+        ).numpy()
+        
+        # Map integers to our encoding and updating the melody
+        melody.extend(self._inv_mappings[output_int] for output_int in output_ints)
         
         return melody
     
-    def save_melody(self, melody, step_duration=0.25, format="midi", file_name="melody.mid"):
-        # Create a music21 stream
-        stream = m21.stream.Stream()
-        
-        # Parse all the symbols in melody and create note/rest objects
+    def save_melody(self, melody, step_duration=0.25, file_name="melody.mid", ticks_per_beat=480):
+        # First pass: parse all the symbols in melody into (note/rest, number of steps) events
+        events = []
         start_symbol = None
         step_counter = 1
         
@@ -88,17 +120,7 @@ class MelodyGenerator:
                 # Passing the first note/rest
                 if start_symbol is not None:
                     
-                    quarter_length_duration = step_duration * step_counter
-                    
-                    # Rest
-                    if start_symbol == "r":
-                        m21_event = m21.note.Rest(quarterLength = quarter_length_duration)
-                    
-                    # Note
-                    else:
-                        m21_event = m21.note.Note(int(start_symbol), quarterLength = quarter_length_duration)
-                   
-                    stream.append(m21_event)
+                    events.append((start_symbol, step_counter))
                     
                     # Resetting the step counter
                     step_counter = 1
@@ -108,21 +130,48 @@ class MelodyGenerator:
             # Case-2: Prolongation sign "_"
             else:
                 step_counter += 1
-                
+        
+        # Second pass: write the events as MIDI messages directly, instead of building music21 note/rest objects. MIDI message times are relative to the previous message, in ticks.
+        midi_file = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+        track = mido.MidiTrack()
+        midi_file.tracks.append(track)
+        track.append(mido.MetaMessage("set_tempo", tempo=mido.bpm2tempo(120)))
+        
+        # Ticks since the last message, accumulated over rests
+        delta_ticks = 0
+        
+        for start_symbol, steps in events:
+            # A beat is a quarter-note, and step_duration is in quarter-notes
+            duration_ticks = int(round(step_duration * steps * ticks_per_beat))
+            
+            # Rest
+            if start_symbol == "r":
+                delta_ticks += duration_ticks
             
-        # Write the m21 stream to a midi file
-        stream.write(format, file_name)
+            # Note
+            else:
+                track.append(mido.Message("note_on", note=int(start_symbol), velocity=90, time=delta_ticks))
+                track.append(mido.Message("note_off", note=int(start_symbol), velocity=0, time=duration_ticks))
+                delta_ticks = 0
+        
+        # Write the midi file
+        midi_file.save(file_name)
+
+# Loading the model once when the app starts, instead of on every request
+mg = MelodyGenerator()
+# The generator and the saved melody file are shared between requests, so only one request can use them at a time
+mg_lock = threading.Lock()
 
 @app.route('/predict',methods=['POST'])
 def predict():
     '''
     For rendering results on HTML GUI
     '''
-    mg = MelodyGenerator()
     seed = request.form.get("melody")
-    melody = mg.generate_melody(seed, 500, SEQUENCE_LENGTH, 0.3)
-    
-    mg.save_melody(melody)
+    with mg_lock:
+        melody = mg.generate_melody(seed, 500, SEQUENCE_LENGTH, 0.3)
+        
+        mg.save_melody(melody)
     
     melody = " ".join(melody)
     
@@ -134,5 +183,5 @@ def download_file():
     return send_file(p, as_attachment=True)
 
 if __name__ == "__main__":
-        app.run(debug=True)
+        app.run()
 
@@ -1,9 +1,9 @@
 # Imports
 import os
+import multiprocessing
 # Music21 enables us to manipulate symbolic music data efficiently, and helps in the conversion of music files to a specified format.
 import music21 as m21
 import json
-import tensorflow.keras as keras
 import numpy as np
 
 
@@ -33,27 +33,28 @@ ACCEPTABLE_DURATIONS = [
     3,
     4
 ]
+# Set of the acceptable durations for constant-time membership checks.
+ACCEPTABLE_DURATIONS_SET = frozenset(ACCEPTABLE_DURATIONS)
 
-# Loading the folk songs in kern
-def load_songs_in_kern(dataset_path):
-    # Go through all the files in the dataset and load them with music21.
+# Finding the paths of the folk songs in kern
+def find_songs_in_kern(dataset_path):
+    # Go through all the files in the dataset and collect the paths of the kern files.
     
-    songs = []
+    song_paths = []
     
     # 'os.walk()' goes through all the files and folders recursively given the parent folder.
     for path, subdir, files in os.walk(dataset_path):
         for file in files:
             # Filtering the kern files out of all the files. Done by checking the last three letters i.e., the extension.
             if file[-3:] == "krn":
-                song =  m21.converter.parse(os.path.join(path, file))
-                songs.append(song)
-    return songs
+                song_paths.append(os.path.join(path, file))
+    return song_paths
 
 # Checking whether all the notes and rests of the song are acceptable or not.
-def has_acceptable_durations(song, acceptable_durations):
-    # '.flat' function of music21 flattens the list, and 'notesAndRests' returns only the notes and rests out of the flattened list.
-    for note in song.flat.notesAndRests:
-        if note.duration.quarterLength not in ACCEPTABLE_DURATIONS:
+# Takes the notes and rests of the song, i.e., 'song.flat.notesAndRests', so that the song is flattened only once for both this check and the encoding.
+def has_acceptable_durations(notes_and_rests, acceptable_durations):
+    for note in notes_and_rests:
+        if note.duration.quarterLength not in acceptable_durations:
             return False
     return True
 
@@ -61,7 +62,8 @@ def has_acceptable_durations(song, acceptable_durations):
 # The reason for transposing the songs to C-major or A-minor is so that we can learn patterns from a smaller dataset too. For learning in all the 24 keys, larger dataset will be required and will be computationally way too expensive.
 
 # Transpose songs to C-major if in major mode, and in A-minor if in minor mode.
-def transpose(song):
+# With 'in_place=True' the song itself is transposed instead of a copy of it, so the notes already taken out of the song are transposed too.
+def transpose(song, in_place=False):
     # Get the key from the song, if mentioned.
     parts = song.getElementsByClass(m21.stream.Part) # Parts is analogous to bars of the song.
     measures_part0 = parts[0].getElementsByClass(m21.stream.Measure)
@@ -79,14 +81,14 @@ def transpose(song):
     elif key.mode == "minor":
         interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch("A"))
     
-    # Transposing the song by the calculated interval.
-    transposed_song = song.transpose(interval)
+    # Transposing the song by the calculated interval. music21 returns None when transposing in place, hence returning the song itself in that case.
+    transposed_song = song.transpose(interval, inPlace=in_place)
     
-    return transposed_song
+    return song if in_place else transposed_song
 
 
 # ### Encoding the song
-# Input will be a song as a music21 object and it will return the song as a string which will be the song encoded in time series representation. 
+# Input will be the notes and rests of a song as music21 objects, i.e., 'song.flat.notesAndRests', and it will return the song as a string which will be the song encoded in time series representation. 
 # 
 # For example, suppose a song has pitch = 60 (middle C), and duration = 1 (in quarter notes). So this will be encoded as a list initially where each item corresponds to a **sixteenth note**. 
 # 
@@ -94,11 +96,12 @@ def transpose(song):
 # 
 # The duration adds to 1 as each note is 16th note and 4 of those makes a quarter-note which is equal to the duration of 1. So setting time_step=0.25, defaults it to a sixteenth note.
 
-def encode_song(song, time_step=0.25):
+def encode_song(notes_and_rests, time_step=0.25):
     
-    encoded_song = []
+    symbols = []
+    steps = []
     
-    for event in song.flat.notesAndRests:
+    for event in notes_and_rests:
         # Handling notes
         if isinstance(event, m21.note.Note):
             symbol = event.pitch.midi
@@ -108,44 +111,65 @@ def encode_song(song, time_step=0.25):
             symbol = "r"
             
         # Converting to time-series representation
-        # Casted to int because a for-loop needs to be run for number of steps.
-        steps = int(event.duration.quarterLength / time_step)
-        
-        # We need either the MIDI number or the symbol 'r', for the *first* step. Then for the note being held, we want underscore.
-        for step in range(steps):
-            if step == 0:
-                encoded_song.append(symbol)
-            else:
-                encoded_song.append("_")
+        # Casted to int because the event is held for a whole number of steps.
+        symbols.append(str(symbol))
+        steps.append(int(event.duration.quarterLength / time_step))
+    
+    symbols = np.array(symbols, dtype=object)
+    steps = np.array(steps, dtype=np.int64)
+    
+    # We need either the MIDI number or the symbol 'r', for the *first* step of each event. Then for the note being held, we want underscore.
+    # So every step starts as an underscore, and the symbols are written at the first step of their events in one go, instead of appending step by step.
+    encoded_song = np.full(steps.sum(), "_", dtype=object)
+    first_steps = np.cumsum(steps) - steps
+    # Events shorter than a step take no steps at all, so they are left out.
+    has_steps = steps > 0
+    encoded_song[first_steps[has_steps]] = symbols[has_steps]
                 
-    # Converting encoded song to string. 'map()' will convert individual elements to strings, if not already.
-    encoded_song = " ".join(map(str, encoded_song))
+    # Converting encoded song to string.
+    encoded_song = " ".join(encoded_song)
     
     return encoded_song
 
+def process_song(args):
+    # Filter, transpose, encode and save a single song. Takes a (song index, song path) tuple so that it can be used with 'multiprocessing.Pool.map()'.
+    # Returns whether the song was saved.
+    i, song_path = args
+    # Parsing here, in the worker process, avoids pickling music21 streams between processes.
+    song = m21.converter.parse(song_path)
+    
+    # '.flat' function of music21 flattens the list, and 'notesAndRests' returns only the notes and rests out of the flattened list.
+    # Flattening builds a new stream, so it is done only once and the notes and rests are reused below.
+    notes_and_rests = list(song.flat.notesAndRests)
+    
+    # Filter out the songs that don't have acceptable durations.
+    if not has_acceptable_durations(notes_and_rests, ACCEPTABLE_DURATIONS_SET):
+        return False # Skip the song if it does not have acceptable notes and rests.
+    
+    # Transposing songs to C-major/A-minor. Done in place, so that 'notes_and_rests' holds the transposed notes.
+    transpose(song, in_place=True)
+    
+    # Encoding the song to time-series representation
+    encoded_song = encode_song(notes_and_rests)
+    
+    # Save the song to a txt file
+    save_path = os.path.join(SAVE_DIR, str(i))
+    
+    with open(save_path, "w") as fp:
+        fp.write(encoded_song)
+    
+    return True
+
 def preprocess(dataset_path):
-    # Loading the folk songs.
-    print("Loading songs...")
-    songs = load_songs_in_kern(dataset_path)
-    print(f"Loaded {len(songs)} songs.")
-    
-    for i, song in enumerate(songs):
-        # Filter out the songs that don't have acceptable durations.
-        if not has_acceptable_durations(song, ACCEPTABLE_DURATIONS):
-            # To make an if statement test if something didn’t happen, you can put the not operator in front of the condition at hand.
-            continue # Skip the song if it does not have acceptable notes and rests.
-        
-        # Transposing songs to C-major/A-minor
-        song = transpose(song)
-        
-        # Encoding the song to time-series representation
-        encoded_song = encode_song(song)
-        
-        # Save the song to a txt file
-        save_path = os.path.join(SAVE_DIR, str(i))
-        
-        with open(save_path, "w") as fp:
-            fp.write(encoded_song)
+    # Finding the folk songs.
+    print("Finding songs...")
+    song_paths = find_songs_in_kern(dataset_path)
+    print(f"Found {len(song_paths)} songs.")
+    
+    # Each song is independent of the others, so they are processed in parallel over all the CPU cores.
+    with multiprocessing.Pool() as pool:
+        saved = pool.map(process_song, enumerate(song_paths))
+    print(f"Processed {sum(saved)} songs.")
 
 
 # ### Merging separate string music files into one file
@@ -160,17 +184,18 @@ def load(file_path):
 def create_single_file_dataset(dataset_path, dataset_file_path, sequence_length):
     # Having number of slashes equal to the sequence length
     new_song_delimeter = "/ " * sequence_length
-    songs = ""
+    # Collecting the songs in a list and joining them once, as repeated string concatenation copies the whole dataset for every song.
+    songs = []
     
     # Load encoded songs and add delimeters
     for path, _, files in os.walk(dataset_path):
         for file in files:
             file_path = os.path.join(path, file)
             song = load(file_path)
-            songs = songs + song + " " + new_song_delimeter
+            songs.append(song + " " + new_song_delimeter)
     
     # As the new song delimeter is sequence length number of slashes each followed by a space, we don't want space after the last slash, hence slicing the string.
-    songs = songs[:-1]
+    songs = "".join(songs)[:-1]
     
     with open(dataset_file_path, "w") as fp:
         fp.write(songs)
@@ -181,34 +206,38 @@ def create_single_file_dataset(dataset_path, dataset_file_path, sequence_length)
 # ### Mapping function
 # The songs in form of strings have some values other than integers like "_" and "r". A neural network can only work with numbers. Hence this function will map the non-integer values to an integer value which can be interpreted by the neural network.
 
+# Mappings loaded from MAPPING_PATH, cached so that the JSON file is read and parsed only once.
+_MAPPINGS_CACHE = None
+
+def _get_mappings():
+    global _MAPPINGS_CACHE
+    if _MAPPINGS_CACHE is None:
+        with open(MAPPING_PATH, "r") as fp:
+            _MAPPINGS_CACHE = json.load(fp)
+    return _MAPPINGS_CACHE
+
 def create_mapping(songs, mapping_path):
-    mappings = {}
-    
-    # Identify the vocabulary
-    songs = songs.split()
-    vocab = list(set(songs))
+    global _MAPPINGS_CACHE
     
-    # Creating mappings
-    for i, symbol in enumerate(vocab):
-        mappings[symbol] = i
+    # Identify the vocabulary and create the mappings. The vocabulary is sorted, as the order of a set changes between runs, which would map the symbols to different integers every time the preprocessing is run.
+    mappings = {symbol: i for i, symbol in enumerate(sorted(set(songs.split())))}
     
     # Saving the vocabulary to a JSON file
     with open(mapping_path, "w") as fp:
         json.dump(mappings, fp, indent=4) # 'indent=4' makes the file more readable by not storing everything in one line.
+    
+    # Clearing the cached mappings, as they may be out of date now
+    _MAPPINGS_CACHE = None
 
 def convert_songs_to_int(songs):
-    int_songs = []
-    
     # Load mappings
-    with open(MAPPING_PATH, "r") as fp:
-        mappings = json.load(fp)
+    mappings = _get_mappings()
         
     # Cast the songs string to a list
     songs = songs.split()
     
-    # Mapping songs to int
-    for symbol in songs:
-        int_songs.append(mappings[symbol])
+    # Mapping songs to int, filling a preallocated numpy array instead of appending to a list
+    int_songs = np.fromiter((mappings[symbol] for symbol in songs), dtype=np.int32, count=len(songs))
         
     return int_songs
 
@@ -217,21 +246,16 @@ def generate_training_sequences(sequence_length):
     songs = load(SINGLE_FILE_DATASET)
     int_songs = convert_songs_to_int(songs)
     
-    # Generate the training sequences
-    inputs = []
-    targets = []
-    
-    # Number of sequences that can be made from a given number of songs
-    num_sequences = len(int_songs) - sequence_length
-    for i in range(num_sequences):
-        inputs.append(int_songs[i:i+sequence_length])
-        targets.append(int_songs[i+sequence_length])
+    # Generate the training sequences. Each window of (sequence length + 1) symbols gives an input sequence and the target that follows it. 'sliding_window_view()' returns a view over 'int_songs', so no copies of the sequences are made.
+    windows = np.lib.stride_tricks.sliding_window_view(int_songs, sequence_length + 1)
+    inputs = windows[:, :-1]
+    targets = windows[:, -1].copy()
     
     # One-hot encoding the sequences
-    vocabulary = len(set(int_songs))
+    vocabulary = len(np.unique(int_songs))
     # Dimensions of the inputs will be (Number of sequences, sequence length, vocabulary size)
-    inputs = keras.utils.to_categorical(inputs, num_classes=vocabulary)
-    targets = np.array(targets)
+    # One-hot values are only 0 or 1, so they are stored as uint8 instead of float32, which takes a quarter of the memory.
+    inputs = np.eye(vocabulary, dtype=np.uint8)[inputs]
     
     return inputs, targets
 